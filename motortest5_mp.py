@@ -11,8 +11,17 @@
 # Motors are driven by the Lua script on the flight controller.
 # USE ONLY ON TEST BENCH.
 
+import time
+
 TEST_PARAM_NAME = "SCR_USER4"
 SLEEP_MS = 1000  # loop rate: 1 Hz
+PARAM_POLL_EVERY_N_SEC = 5  # re-read SCR_USER4 every N loop ticks
+PRINT_EVERY_N_SEC = 5       # status line every N ticks (WARN/ABORT: always)
+
+# ESC_TELEMETRY_1_TO_4 / ESC_TELEMETRY_5_TO_8 message ids, requested
+# from the FC at twice the loop rate so each tick sees a fresh sample.
+ESC_TELEM_MSG_IDS     = (11030, 11031)
+ESC_TELEM_INTERVAL_US = SLEEP_MS * 1000 // 2
 
 # ---------------- STAGES (reference for checks) ----------------
 # These durations and expected values are only used for anomaly checks.
@@ -44,6 +53,11 @@ STAGES = [
 
 TOTAL_TEST_DURATION_SEC = sum(s["duration_sec"] for s in STAGES)
 
+# Cumulative stage end times (sec from start)
+_stage_ends = []
+for _s in STAGES:
+    _stage_ends.append((_stage_ends[-1] if _stage_ends else 0) + _s["duration_sec"])
+
 # --------------- SAFETY THRESHOLDS (placeholders) --------------
 
 AUTO_STOP_ON_ANOMALY = True
@@ -67,22 +81,116 @@ TEMP_DIFF_ABORT        = 20.0     # degC from median
 CURR_EXPECT_WARN_FRAC  = 0.10     # ±10% vs expected (per ESC)
 CURR_EXPECT_ABORT_FRAC = 0.30     # ±30% vs expected (per ESC)
 
+# Abort only when a condition holds for this many consecutive samples,
+# so a single telemetry glitch does not stop the test (1 = no debounce,
+# lower values are treated as 1)
+ABORT_CONFIRM_SAMPLES  = 3
+
+# Per-stage expected values and absolute warn/abort deviations, indexed
+# like STAGES: (exp_rpm, rpm_warn, rpm_abort,
+#               exp_esc_curr, curr_warn, curr_abort,
+#               exp_total_curr, total_warn, total_abort)
+_STAGE_THRESH = []
+for _s in STAGES:
+    _rpm = _s.get("expected_rpm", 0.0) or 0.0
+    _esc = _s.get("expected_esc_curr", 0.0) or 0.0
+    _tot = _s.get("expected_total_curr", 0.0) or 0.0
+    _STAGE_THRESH.append((
+        _rpm, _rpm * RPM_EXPECT_WARN_FRAC, _rpm * RPM_EXPECT_ABORT_FRAC,
+        _esc, _esc * CURR_EXPECT_WARN_FRAC, _esc * CURR_EXPECT_ABORT_FRAC,
+        _tot, _tot * CURR_EXPECT_WARN_FRAC, _tot * CURR_EXPECT_ABORT_FRAC,
+    ))
+
+# Mission Planner cs attribute names, built once
+_ESC_ATTRS = tuple(("esc%d_rpm" % i, "esc%d_curr" % i, "esc%d_temp" % i)
+                   for i in range(1, 9))
+_MAV_ATTRS = ("customfield0", "customfield1", "customfield2", "customfield3",
+              "customfield4", "customfield5")
+
+# Status line template: header, E#: RPM/A/degC, bench totals, LC channels.
+# Named fields are filled from one persistent dict (_status_vals).
+_STATUS_ESC_KEYS = tuple(("r%d" % i, "c%d" % i, "tp%d" % i) for i in range(1, 9))
+_STATUS_LC_KEYS  = ("l1", "l2", "l3", "l4")
+_STATUS_FMT = ("t=%(t)4ds [%(name)s t=%(el)3ds] " +
+               "".join("E%d:%%(%s)4drpm/%%(%s)4.1fA/%%(%s)4.1fC " % ((i + 1,) + k)
+                       for i, k in enumerate(_STATUS_ESC_KEYS)) +
+               "| I_tot=%(itot).1fA V=%(v).1fV " +
+               "| LC: " + ", ".join("L%d=%%(%s).1f" % (i + 1, k)
+                                    for i, k in enumerate(_STATUS_LC_KEYS)))
+
+# Fixed-size per-ESC telemetry buffers, overwritten in place every tick
+_rpms     = [0.0] * 8
+_currents = [0.0] * 8
+_temps    = [0.0] * 8
+_lcs      = [0.0] * 4   # customfield0..3
+_med_buf  = [0.0] * 8   # scratch for median()
+_INF      = float("inf")
+_status_vals = {}      # _STATUS_FMT fields
+
+# Monotonic clock for the loop deadlines. time.monotonic is Python 3 only;
+# in IronPython 2.7 time.clock is a monotonic high-resolution counter.
+try:
+    _monotonic = time.monotonic
+except AttributeError:
+    _monotonic = time.clock
+
+# Abort checks. Each check produces a lane mask per tick (bit i = ESC i+1,
+# totals use bit 0); its history keeps the last ABORT_CONFIRM_SAMPLES
+# masks, newest in the low byte.
+_CONFIRM_SAMPLES = max(1, ABORT_CONFIRM_SAMPLES)
+(CHK_LOW_RPM, CHK_OVER_TEMP, CHK_OVER_CURR, CHK_TOTAL_CURR,
+ CHK_RPM_RANGE, CHK_TEMP_MEDIAN, CHK_CURR_RANGE, CHK_TOTAL_RANGE) = range(8)
+_trip_hist = [0] * 8
+_bad_lanes  = [0] * 8   # confirmed abort lanes per check, this tick
+_warn_lanes = [0] * 8   # warning lanes per check, this tick
+_prev_warn  = [0] * 8   # warning lanes per check, previous tick
+_HIST_MASK = (1 << (8 * _CONFIRM_SAMPLES)) - 1
+_HIST_SHIFTS = tuple(range(0, 8 * _CONFIRM_SAMPLES, 8))
+
+# Messages per check code, only formatted when actually printed
+_ABORT_FMT = (
+    "ESC%d low rpm (%.0f < %.0f)",                          # CHK_LOW_RPM
+    "ESC%d over temperature (%.1fC >= %.1fC)",              # CHK_OVER_TEMP
+    "ESC%d over current (%.1fA > %.1fA)",                   # CHK_OVER_CURR
+    "Total current too high (%.1fA > %.1fA)",               # CHK_TOTAL_CURR
+    "ESC%d rpm out of range (%.0f vs %.0f, %.0f%%)",        # CHK_RPM_RANGE
+    "ESC%d temp off median (%.1fC vs %.1fC, diff=%.1fC)",   # CHK_TEMP_MEDIAN
+    "ESC%d current out of range (%.1fA vs %.1fA, %.0f%%)",  # CHK_CURR_RANGE
+    "Total current out of range (%.1fA vs %.1fA, %.0f%%)",  # CHK_TOTAL_RANGE
+)
+_WARN_FMT = (
+    None, None, None, None,                                 # abort-only checks
+    "ESC%d rpm off (%.0f vs %.0f, %.0f%%)",                 # CHK_RPM_RANGE
+    "ESC%d temp off median (%.1fC vs %.1fC, diff=%.1fC)",   # CHK_TEMP_MEDIAN
+    "ESC%d current off (%.1fA vs %.1fA, %.0f%%)",           # CHK_CURR_RANGE
+    "total current off (%.1fA vs %.1fA, %.0f%%)",           # CHK_TOTAL_RANGE
+)
+
+# check_and_maybe_abort() results
+CHECK_OK, CHECK_ABORT, CHECK_STOPPED, CHECK_POLLED = range(4)
+
 print("=== X8 Motor Test (MP script) ===")
 
 
-def get_stage_at_time(t_sec):
+def set_esc_telem_interval(interval_us):
     """
-    Return (stage_index, stage_elapsed_sec) for given time from start.
-    stage_index is 0-based.
+    Request the ESC telemetry messages every interval_us microseconds
+    (MAV_CMD_SET_MESSAGE_INTERVAL). interval_us = 0 restores the FC default.
+    Returns True if all requests were acknowledged.
     """
-    accum = 0
-    for idx, s in enumerate(STAGES):
-        dur = s["duration_sec"]
-        if t_sec < accum + dur:
-            return idx, t_sec - accum
-        accum += dur
-    # Beyond total duration: stay at last stage
-    return len(STAGES) - 1, STAGES[-1]["duration_sec"]
+    try:
+        import clr
+        clr.AddReference("MAVLink")
+        import MAVLink
+        ok = True
+        for msg_id in ESC_TELEM_MSG_IDS:
+            if not MAV.doCommand(MAVLink.MAV_CMD.SET_MESSAGE_INTERVAL,
+                                 msg_id, interval_us, 0, 0, 0, 0, 0):
+                ok = False
+        return ok
+    except Exception as e:
+        print("WARNING: cannot set ESC telemetry rate (%s)" % e)
+        return False
 
 
 def read_esc_telemetry():
@@ -90,20 +198,19 @@ def read_esc_telemetry():
     Read ESC telemetry from Mission Planner (cs).
     escX_rpm, escX_curr, escX_temp for X = 1..8.
     Returns: (rpms[], currents[], temps[])
+    The returned lists are module buffers, valid until the next call.
     """
-    rpms = []
-    currents = []
-    temps = []
-    for i in range(1, 9):
-        rpm_attr = "esc%d_rpm" % i
-        cur_attr = "esc%d_curr" % i
-        tmp_attr = "esc%d_temp" % i
-        rpm = float(getattr(cs, rpm_attr, 0.0))
-        curr = float(getattr(cs, cur_attr, 0.0))
-        tmp = float(getattr(cs, tmp_attr, 0.0))
-        rpms.append(rpm)
-        currents.append(curr)
-        temps.append(tmp)
+    _ga = getattr
+    _flt = float
+    rpms = _rpms
+    currents = _currents
+    temps = _temps
+    i = 0
+    for rpm_attr, cur_attr, tmp_attr in _ESC_ATTRS:
+        rpms[i] = _flt(_ga(cs, rpm_attr, 0.0))
+        currents[i] = _flt(_ga(cs, cur_attr, 0.0))
+        temps[i] = _flt(_ga(cs, tmp_attr, 0.0))
+        i += 1
     return rpms, currents, temps
 
 
@@ -114,177 +221,330 @@ def read_mav_arduino():
       customfield4    : total current (A)
       customfield5    : total voltage (V)
     Returns: (lc_list[4], total_curr, total_volt)
+    The returned LC list is a module buffer, valid until the next call.
     """
-    lc_fields = ["customfield0", "customfield1", "customfield2", "customfield3"]
-    lcs = []
-    for name in lc_fields:
-        lcs.append(float(getattr(cs, name, 0.0)))
-
-    total_curr = float(getattr(cs, "customfield4", 0.0))
-    total_volt = float(getattr(cs, "customfield5", 0.0))
-
+    _ga = getattr
+    _flt = float
+    lcs = _lcs
+    total_curr = total_volt = 0.0
+    i = 0
+    for name in _MAV_ATTRS:
+        v = _flt(_ga(cs, name, 0.0))
+        if i < 4:
+            lcs[i] = v
+        elif i == 4:
+            total_curr = v
+        else:
+            total_volt = v
+        i += 1
     return lcs, total_curr, total_volt
 
 
 def print_status_line(t_sec, stage_idx, stage_elapsed, rpms, currents, temps, lcs, total_curr, total_volt):
     """
-    Print a compact status line for the console (1 line per second).
+    Print a compact status line for the console.
     """
-    stage = STAGES[stage_idx]
-    line = "t=%4ds [%s t=%3ds] " % (t_sec, stage["name"], stage_elapsed)
+    d = _status_vals
+    d["t"] = t_sec
+    d["name"] = STAGES[stage_idx]["name"]
+    d["el"] = stage_elapsed
+    i = 0
+    for r_key, c_key, tp_key in _STATUS_ESC_KEYS:
+        d[r_key] = int(rpms[i])
+        d[c_key] = currents[i]
+        d[tp_key] = temps[i]
+        i += 1
+    d["itot"] = total_curr
+    d["v"] = total_volt
+    i = 0
+    for key in _STATUS_LC_KEYS:
+        d[key] = lcs[i]
+        i += 1
+
+    print(_STATUS_FMT % d)
 
-    # ESC summary: E#: RPM/A/degC
-    for i in range(8):
-        line += "E%d:%4drpm/%4.1fA/%4.1fC " % (
-            i + 1,
-            int(rpms[i]),
-            currents[i],
-            temps[i]
-        )
 
-    # Arduino / bench totals
-    line += "| I_tot=%.1fA V=%.1fV " % (total_curr, total_volt)
-    # LC channels
-    line += "| LC: " + ", ".join("L%d=%.1f" % (i + 1, v) for i, v in enumerate(lcs))
+def median(values):
+    """
+    Upper median of the valid (positive, non-NaN) readings, or None.
+    """
+    buf = _med_buf
+    n = 0
+    for v in values:
+        if v > 0:  # NaN compares False: filtered too
+            buf[n] = v
+            n += 1
+    if not n:
+        return None
+    # Pad unused slots with +inf so they sort last; sort in place
+    for j in range(n, len(buf)):
+        buf[j] = _INF
+    buf.sort()
+    return buf[n // 2]
+
 
-    print(line)
+def confirm(check, mask):
+    """
+    Shift this tick's lane mask into the history of check.
+    Returns the lanes that tripped on each of the last ABORT_CONFIRM_SAMPLES
+    ticks (0 if none).
+    """
+    h = ((_trip_hist[check] << 8) | mask) & _HIST_MASK
+    _trip_hist[check] = h
+    lanes = 0xFF
+    for shift in _HIST_SHIFTS:
+        lanes &= h >> shift
+    return lanes & 0xFF
 
 
-def median(values):
-    vals = [v for v in values if v == v]  # filter NaN
-    if not vals:
-        return None
-    vals.sort()
-    return vals[len(vals) // 2]
+def lowest_lane(mask):
+    """
+    Index of the lowest set bit of a non-zero lane mask (0-based ESC).
+    """
+    return (mask & -mask).bit_length() - 1
+
+
+def anomaly_args(code, i, stage_idx, rpms, currents, temps, total_curr, med_temp):
+    """
+    Arguments for the _ABORT_FMT / _WARN_FMT message of check code on
+    ESC i (i is ignored for the total-current checks).
+    """
+    thresh = _STAGE_THRESH[stage_idx]
+    exp_rpm, exp_esc_curr, exp_total_curr = thresh[0], thresh[3], thresh[6]
+    if code == CHK_LOW_RPM:
+        return (i + 1, rpms[i], RPM_NEAR_ZERO_ABORT)
+    if code == CHK_OVER_TEMP:
+        return (i + 1, temps[i], TEMP_CRIT_ABORT)
+    if code == CHK_OVER_CURR:
+        return (i + 1, currents[i], ESC_CURR_MAX_ABORT)
+    if code == CHK_TOTAL_CURR:
+        return (total_curr, TOTAL_CURR_MAX_ABORT)
+    if code == CHK_RPM_RANGE:
+        return (i + 1, rpms[i], exp_rpm,
+                abs(rpms[i] - exp_rpm) * 100.0 / exp_rpm)
+    if code == CHK_TEMP_MEDIAN:
+        return (i + 1, temps[i], med_temp, temps[i] - med_temp)
+    if code == CHK_CURR_RANGE:
+        return (i + 1, currents[i], exp_esc_curr,
+                abs(currents[i] - exp_esc_curr) * 100.0 / exp_esc_curr)
+    return (total_curr, exp_total_curr,
+            abs(total_curr - exp_total_curr) * 100.0 / exp_total_curr)
+
+
+def report_abort(code, i, stage_idx, rpms, currents, temps, total_curr, med_temp):
+    """
+    Print the abort reason and request the test stop (SCR_USER4 = 0).
+    Returns CHECK_ABORT.
+    """
+    print("ABORT: %s" % (_ABORT_FMT[code] %
+                         anomaly_args(code, i, stage_idx, rpms, currents, temps, total_curr, med_temp)))
+    if AUTO_STOP_ON_ANOMALY:
+        if Script.ChangeParam(TEST_PARAM_NAME, 0):
+            print("SCR_USER4 set to 0 (test stop requested).")
+        else:
+            print("WARNING: cannot set SCR_USER4 to 0, check params.")
+    return CHECK_ABORT
+
+
+def report_warnings(code, lanes, stage_idx, rpms, currents, temps, total_curr, med_temp):
+    """
+    Print one warning line per lane set in lanes.
+    """
+    while lanes:
+        i = lowest_lane(lanes)
+        lanes &= lanes - 1
+        print("WARN: %s" % (_WARN_FMT[code] %
+                            anomaly_args(code, i, stage_idx, rpms, currents, temps, total_curr, med_temp)))
 
 
 def check_and_maybe_abort(t_sec, stage_idx, stage_elapsed, rpms, currents, temps, lcs, total_curr, total_volt):
     """
-    Apply anomaly checks.
-    Returns True if an abort was requested (sets SCR_USER4 to 0).
+    Apply anomaly checks. Warnings are printed on every out-of-spec
+    sample; aborts need ABORT_CONFIRM_SAMPLES consecutive ones.
+    The checks only produce (check code, ESC) results; messages are
+    formatted when a warning or abort is actually printed.
+    Returns CHECK_ABORT if an abort was requested (sets SCR_USER4 to 0),
+    CHECK_STOPPED if SCR_USER4 was found at 0 before reporting an
+    anomaly, CHECK_POLLED if it was read and is still on, CHECK_OK
+    otherwise.
     """
-    stage = STAGES[stage_idx]
-    exp_rpm        = stage.get("expected_rpm", 0.0)        or 0.0
-    exp_esc_curr   = stage.get("expected_esc_curr", 0.0)   or 0.0
-    exp_total_curr = stage.get("expected_total_curr", 0.0) or 0.0
-
-    def abort(reason):
-        print("ABORT: %s" % reason)
-        if AUTO_STOP_ON_ANOMALY:
-            if Script.ChangeParam(TEST_PARAM_NAME, 0):
-                print("SCR_USER4 set to 0 (test stop requested).")
-            else:
-                print("WARNING: cannot set SCR_USER4 to 0, check params.")
-        return True
+    (exp_rpm, rpm_warn, rpm_abort,
+     exp_esc_curr, curr_warn, curr_abort,
+     exp_total_curr, total_warn, total_abort) = _STAGE_THRESH[stage_idx]
+    bad = _bad_lanes
+    warn_lanes = _warn_lanes
 
     # ------------ Immediate abort checks ----------------
 
-    if stage_elapsed >= RAMP_UP_GRACE_SEC:
-        # ESC rpm close to zero while test is active
-        for i in range(8):
-            if rpms[i] > 0 and rpms[i] < RPM_NEAR_ZERO_ABORT:
-                return abort("ESC%d low rpm (%.0f < %.0f)" %
-                             (i + 1, rpms[i], RPM_NEAR_ZERO_ABORT))
-
-    # ESC critical temperature
+    # Lane masks for all per-ESC limits, built in one pass:
+    # rpm close to zero while test is active, critical temperature,
+    # over-current
+    ramped = stage_elapsed >= RAMP_UP_GRACE_SEC
+    rpm_min  = RPM_NEAR_ZERO_ABORT
+    temp_max = TEMP_CRIT_ABORT
+    curr_max = ESC_CURR_MAX_ABORT
+    low = hot = over = 0
     for i in range(8):
-        if temps[i] >= TEMP_CRIT_ABORT and temps[i] > 0:
-            return abort("ESC%d over temperature (%.1fC >= %.1fC)" %
-                         (i + 1, temps[i], TEMP_CRIT_ABORT))
+        tp = temps[i]
+        low  |= (0 < rpms[i] < rpm_min) << i
+        hot  |= (tp > 0 and tp >= temp_max) << i
+        over |= (currents[i] > curr_max) << i
+    if not ramped:
+        low = 0
 
-    # ESC over-current
-    for i in range(8):
-        if currents[i] > ESC_CURR_MAX_ABORT:
-            return abort("ESC%d over current (%.1fA > %.1fA)" %
-                         (i + 1, currents[i], ESC_CURR_MAX_ABORT))
+    bad[CHK_LOW_RPM]   = confirm(CHK_LOW_RPM, low)
+    bad[CHK_OVER_TEMP] = confirm(CHK_OVER_TEMP, hot)
+    bad[CHK_OVER_CURR] = confirm(CHK_OVER_CURR, over)
 
     # Total bench over-current (Arduino / customfield4)
-    if total_curr > TOTAL_CURR_MAX_ABORT:
-        return abort("Total current too high (%.1fA > %.1fA)" %
-                     (total_curr, TOTAL_CURR_MAX_ABORT))
+    bad[CHK_TOTAL_CURR] = confirm(CHK_TOTAL_CURR, total_curr > TOTAL_CURR_MAX_ABORT)
 
     # ------------ Two-level checks (warn + abort) --------
+    # Each check builds abort + warn lane masks; warnings are only
+    # printed when the check does not abort.
 
     # 1) rpm vs expected for this stage
-    if stage_elapsed >= RAMP_UP_GRACE_SEC and exp_rpm > 0:
+    b = w = 0
+    if ramped and exp_rpm > 0:
         for i in range(8):
-            frac = abs(rpms[i] - exp_rpm) / exp_rpm
-            if frac > RPM_EXPECT_ABORT_FRAC:
-                return abort("ESC%d rpm out of range (%.0f vs %.0f, %.0f%%)" %
-                             (i + 1, rpms[i], exp_rpm, frac * 100.0))
-            elif frac > RPM_EXPECT_WARN_FRAC:
-                print("WARN: ESC%d rpm off (%.0f vs %.0f, %.0f%%)" %
-                      (i + 1, rpms[i], exp_rpm, frac * 100.0))
+            dev = abs(rpms[i] - exp_rpm)
+            b |= (dev > rpm_abort) << i
+            w |= (dev > rpm_warn) << i
+    bad[CHK_RPM_RANGE] = confirm(CHK_RPM_RANGE, b)
+    warn_lanes[CHK_RPM_RANGE] = w
 
     # 2) temperature vs median ESC temperature
-    med_temp = median([t for t in temps if t > 0])
+    med_temp = median(temps)
+    b = w = 0
     if med_temp is not None:
         for i in range(8):
-            if temps[i] <= 0:
-                continue
-            diff = temps[i] - med_temp
-            adiff = abs(diff)
-            if adiff > TEMP_DIFF_ABORT:
-                return abort("ESC%d temp off median (%.1fC vs %.1fC, diff=%.1fC)" %
-                             (i + 1, temps[i], med_temp, diff))
-            elif adiff > TEMP_DIFF_WARN:
-                print("WARN: ESC%d temp off median (%.1fC vs %.1fC, diff=%.1fC)" %
-                      (i + 1, temps[i], med_temp, diff))
+            tp = temps[i]
+            adiff = abs(tp - med_temp)
+            b |= (tp > 0 and adiff > TEMP_DIFF_ABORT) << i
+            w |= (tp > 0 and adiff > TEMP_DIFF_WARN) << i
+    bad[CHK_TEMP_MEDIAN] = confirm(CHK_TEMP_MEDIAN, b)
+    warn_lanes[CHK_TEMP_MEDIAN] = w
 
     # 3) current vs expected per ESC
+    b = w = 0
     if exp_esc_curr > 0:
         for i in range(8):
-            frac = abs(currents[i] - exp_esc_curr) / exp_esc_curr
-            if frac > CURR_EXPECT_ABORT_FRAC:
-                return abort("ESC%d current out of range (%.1fA vs %.1fA, %.0f%%)" %
-                             (i + 1, currents[i], exp_esc_curr, frac * 100.0))
-            elif frac > CURR_EXPECT_WARN_FRAC:
-                print("WARN: ESC%d current off (%.1fA vs %.1fA, %.0f%%)" %
-                      (i + 1, currents[i], exp_esc_curr, frac * 100.0))
+            dev = abs(currents[i] - exp_esc_curr)
+            b |= (dev > curr_abort) << i
+            w |= (dev > curr_warn) << i
+    bad[CHK_CURR_RANGE] = confirm(CHK_CURR_RANGE, b)
+    warn_lanes[CHK_CURR_RANGE] = w
 
     # 4) total current vs expected
-    if exp_total_curr > 0:
-        frac_tot = abs(total_curr - exp_total_curr) / exp_total_curr
-        if frac_tot > CURR_EXPECT_ABORT_FRAC:
-            return abort("Total current out of range (%.1fA vs %.1fA, %.0f%%)" %
-                         (total_curr, exp_total_curr, frac_tot * 100.0))
-        elif frac_tot > CURR_EXPECT_WARN_FRAC:
-            print("WARN: total current off (%.1fA vs %.1fA, %.0f%%)" %
-                  (total_curr, exp_total_curr, frac_tot * 100.0))
-
-    return False  # no abort requested
-
-
-# ---------------------- MAIN SCRIPT ----------------------------
+    dev_tot = abs(total_curr - exp_total_curr)
+    active = exp_total_curr > 0
+    bad[CHK_TOTAL_RANGE] = confirm(CHK_TOTAL_RANGE, active and dev_tot > total_abort)
+    warn_lanes[CHK_TOTAL_RANGE] = 1 if active and dev_tot > total_warn else 0
+
+    # Warning lanes that were not set on the previous tick
+    prev = _prev_warn
+    fresh = 0
+    for code in range(CHK_RPM_RANGE, CHK_TOTAL_RANGE + 1):
+        fresh |= warn_lanes[code] & ~prev[code]
+        prev[code] = warn_lanes[code]
+
+    if not (any(bad) or any(warn_lanes)):
+        return CHECK_OK
+
+    # ------------ Reporting ------------------------------
+    # SCR_USER4 is only polled every few ticks: re-read it before an
+    # abort or a new warning, so motors spinning down after a clean stop
+    # do not produce false warnings or aborts. Standing warnings are
+    # repeated without a read. If it cannot be read, report.
+    polled = False
+    if fresh or any(bad):
+        param = Script.GetParam(TEST_PARAM_NAME)
+        if param is not None:
+            if param < 0.5:
+                return CHECK_STOPPED
+            polled = True
+
+    # Immediate aborts: lowest tripped ESC, then low rpm / over
+    # temperature / over-current for that ESC
+    trip = bad[CHK_LOW_RPM] | bad[CHK_OVER_TEMP] | bad[CHK_OVER_CURR]
+    if trip:
+        i = lowest_lane(trip)
+        if bad[CHK_LOW_RPM] >> i & 1:
+            code = CHK_LOW_RPM
+        elif bad[CHK_OVER_TEMP] >> i & 1:
+            code = CHK_OVER_TEMP
+        else:
+            code = CHK_OVER_CURR
+        return report_abort(code, i, stage_idx, rpms, currents, temps, total_curr, med_temp)
 
-current = Script.GetParam(TEST_PARAM_NAME)
-if current is None:
-    print("ERROR: cannot read param %s" % TEST_PARAM_NAME)
-    raise SystemExit
+    # Total over-current, then the two-level checks in order
+    for code in range(CHK_TOTAL_CURR, CHK_TOTAL_RANGE + 1):
+        if bad[code]:
+            return report_abort(code, lowest_lane(bad[code]), stage_idx, rpms, currents, temps, total_curr, med_temp)
+        if warn_lanes[code]:
+            report_warnings(code, warn_lanes[code], stage_idx, rpms, currents, temps, total_curr, med_temp)
 
-if current < 0.5:
-    # Test is OFF -> turn it ON and start monitoring
-    if not Script.ChangeParam(TEST_PARAM_NAME, 1):
-        print("ERROR: cannot set %s to 1" % TEST_PARAM_NAME)
-        raise SystemExit
+    return CHECK_POLLED if polled else CHECK_OK
 
-    print("SCR_USER4=1 (Lua test requested).")
-    print("Planned test duration: ~%d minutes." % (TOTAL_TEST_DURATION_SEC // 60))
-    print("To stop: set SCR_USER4=0 or let this script abort on anomaly.")
 
-    # Main loop: 1 Hz, until total duration or param goes back to 0
-    for t in range(TOTAL_TEST_DURATION_SEC):
-        stage_idx, stage_elapsed = get_stage_at_time(t)
+def run_test():
+    """
+    Main loop: 1 Hz, until total duration or param goes back to 0.
+    Kept in a function so the per-tick state lives in fast locals.
+    Returns SCR_USER4 as read on the last tick, or None if it was not
+    read then (abort, read error, or the last tick had no poll).
+    """
+    t0 = _monotonic()
+    current = None
+    stage_idx = 0
+    stage_start = 0
+    last_stage = len(STAGES) - 1
+    next_poll = PARAM_POLL_EVERY_N_SEC
+    t = 0
+    while t < TOTAL_TEST_DURATION_SEC:
+        current = None
+
+        # Advance to the next stage when the current one has ended
+        while stage_idx < last_stage and t >= _stage_ends[stage_idx]:
+            stage_start = _stage_ends[stage_idx]
+            stage_idx += 1
+        stage_elapsed = t - stage_start
 
         rpms, currents, temps = read_esc_telemetry()
         lcs, total_curr, total_volt = read_mav_arduino()
 
-        print_status_line(t, stage_idx, stage_elapsed, rpms, currents, temps, lcs, total_curr, total_volt)
+        if t % PRINT_EVERY_N_SEC == 0:
+            print_status_line(t, stage_idx, stage_elapsed, rpms, currents, temps, lcs, total_curr, total_volt)
 
-        if check_and_maybe_abort(t, stage_idx, stage_elapsed, rpms, currents, temps, lcs, total_curr, total_volt):
+        result = check_and_maybe_abort(t, stage_idx, stage_elapsed, rpms, currents, temps, lcs, total_curr, total_volt)
+        if result == CHECK_ABORT:
             break  # abort requested
+        if result == CHECK_STOPPED:
+            print("SCR_USER4 is 0, stopping script at t=%ds." % t)
+            current = 0
+            break
 
-        Script.Sleep(SLEEP_MS)
+        # Sleep until the next absolute tick deadline, so the time spent
+        # reading and checking does not add up as drift over the test.
+        # After a stall the missed deadlines are dropped, not run back to
+        # back: a burst would re-read the same cached telemetry and let a
+        # single sample satisfy ABORT_CONFIRM_SAMPLES.
+        t += 1
+        delay_ms = t * SLEEP_MS - (_monotonic() - t0) * 1000.0
+        if delay_ms < -SLEEP_MS:
+            missed = int(-delay_ms // SLEEP_MS) + 1
+            t += missed
+            delay_ms += missed * SLEEP_MS
+        if delay_ms > 0:
+            Script.Sleep(int(delay_ms))
+
+        if result == CHECK_POLLED:
+            # SCR_USER4 was just read by the checks: restart the window
+            next_poll = t + PARAM_POLL_EVERY_N_SEC
+            continue
+        if t < next_poll:
+            continue
+        next_poll = t + PARAM_POLL_EVERY_N_SEC
 
         # If Lua or user already set SCR_USER4 to 0, stop logging
         current = Script.GetParam(TEST_PARAM_NAME)
@@ -292,18 +552,53 @@ if current < 0.5:
             print("WARNING: cannot read %s, exiting script loop." % TEST_PARAM_NAME)
             break
         if current < 0.5:
-            print("SCR_USER4 is 0, stopping script at t=%ds." % (t + 1))
+            print("SCR_USER4 is 0, stopping script at t=%ds." % t)
             break
 
-    # At the end, if SCR_USER4 is still 1, try to force it to 0
-    current = Script.GetParam(TEST_PARAM_NAME) or 0
-    if current >= 0.5:
-        if Script.ChangeParam(TEST_PARAM_NAME, 0):
-            print("Test ended: SCR_USER4 set to 0.")
+    return current
+
+
+# ---------------------- MAIN SCRIPT ----------------------------
+
+current = Script.GetParam(TEST_PARAM_NAME)
+if current is None:
+    print("ERROR: cannot read param %s" % TEST_PARAM_NAME)
+    raise SystemExit
+
+if current < 0.5:
+    # Test is OFF -> turn it ON and start monitoring.
+    # The telemetry rate is requested first: doCommand blocks on each ACK,
+    # and the motors must not run unmonitored while it waits.
+    if set_esc_telem_interval(ESC_TELEM_INTERVAL_US):
+        print("ESC telemetry requested at %.0f Hz." % (1e6 / ESC_TELEM_INTERVAL_US))
+
+    try:
+        if not Script.ChangeParam(TEST_PARAM_NAME, 1):
+            print("ERROR: cannot set %s to 1" % TEST_PARAM_NAME)
+            raise SystemExit
+
+        print("SCR_USER4=1 (Lua test requested).")
+        print("Planned test duration: ~%d minutes." % (TOTAL_TEST_DURATION_SEC // 60))
+        print("To stop: set SCR_USER4=0 or let this script abort on anomaly.")
+
+        current = run_test()
+
+        # At the end, if SCR_USER4 is still 1, try to force it to 0
+        # (no new read if the loop polled it on its last tick)
+        if current is None:
+            current = Script.GetParam(TEST_PARAM_NAME)
+        current = current or 0
+        if current >= 0.5:
+            if Script.ChangeParam(TEST_PARAM_NAME, 0):
+                print("Test ended: SCR_USER4 set to 0.")
+            else:
+                print("WARNING: cannot set SCR_USER4 to 0, check params.")
         else:
-            print("WARNING: cannot set SCR_USER4 to 0, check params.")
-    else:
-        print("Test ended: SCR_USER4 was already 0.")
+            print("Test ended: SCR_USER4 was already 0.")
+    finally:
+        # Back to the FC default stream rates, also when the loop raised
+        # or the script was stopped from Mission Planner
+        set_esc_telem_interval(0)
 
 else:
     # Test is ON -> turn it OFF (quick toggle)